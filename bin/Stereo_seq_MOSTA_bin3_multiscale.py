@@ -6,31 +6,42 @@ Multiscale Workflow - bin3(~2um) Stereo-seq MOSTA data
 import argparse
 import os
 import gc
-import tempfile
-import shutil
 import warnings
 import itertools
 import math
+import functools
 from typing import List
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor
 import multiprocessing as mp
 
 import numpy as np
 import pandas as pd
+from scipy import sparse
 import scanpy as sc
 import squidpy as sq
 import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from PIL import Image
 from joblib import Parallel, delayed
-from scipy.stats import rankdata
 
 import SPIX
 from SPIX.image_processing.image_cache import *
 import anndata as ad
 
+from fast_rank import min_rank_desc
+
 # Set matplotlib backend for non-interactive use
 matplotlib.use("Agg")
+plt.ioff()
+
+# Per-process AnnData for grid pool workers (set by _init_worker)
+_GLOBAL_ADATA = None
+# (CSC counts, per-spot totals) for gene tiles under --grid_csc_lognorm
+_GLOBAL_COUNTS = None
+# Side of one gene grid cell in inches; cells are GRID_CELL_INCHES * dpi px
+GRID_CELL_INCHES = 4
 
 
 def setup_environment(omp_threads=64, openblas_threads=64, mkl_threads=64, numexpr_threads=64):
@@ -42,30 +53,21 @@ def setup_environment(omp_threads=64, openblas_threads=64, mkl_threads=64, numex
 
 
 def transform_coordinates(adata):
-    """Transform spatial coordinates."""
-    y = adata.obsm['spatial'][:, 0].copy()
-    x = adata.obsm['spatial'][:, 1].copy()
-    adata.obsm['spatial'][:, 0] = x.copy()
-    adata.obsm['spatial'][:, 1] = y.copy()
-    
-    coords = adata.obsm['spatial'].copy()
-    coords[:, 1] = coords[:, 1].max() - coords[:, 1]
-    adata.obsm['spatial'] = coords
-    
-    coords = adata.obsm['spatial'].copy()
-    coords[:, 0] = coords[:, 0].max() - coords[:, 0]
-    adata.obsm['spatial'] = coords
+    """Transform spatial coordinates (swap x/y, then flip both axes)."""
+    coords = adata.obsm['spatial']
+    out = np.empty_like(coords)
+    out[:, 0] = coords[:, 1].max() - coords[:, 1]
+    out[:, 1] = coords[:, 0].max() - coords[:, 0]
+    adata.obsm['spatial'] = out
     return adata
 
 
-def calc_scale(adata, scale_id, res, comp, adata_path=None, dims_use=None, 
-               embedding_key=None, segment_method=None, use_cached_image=None,
-               moran_thresh=0):
+def calc_scale(adata, scale_id, res, comp, dims_use=None, embedding_key=None,
+               segment_method=None, use_cached_image=None, moran_thresh=0):
     """Single-scale calculation function."""
-    if adata_path:
-        ad = sc.read_h5ad(adata_path)
-    else:
-        ad = adata.copy()
+    # Per-scale copy: SPIX writes the segmentation into the AnnData and may
+    # normalize X in place
+    ad = adata.copy()
     
     # segmentation
     SPIX.sp.segment_image(
@@ -100,35 +102,65 @@ def calc_scale(adata, scale_id, res, comp, adata_path=None, dims_use=None,
     
     if moran.empty:
         warnings.warn(f"[{scale_id}] No MoranI result ")
-        return pd.DataFrame()
+        return None
     
-    # rank
-    moran['rank_' + scale_id] = rankdata(-moran['I'], method='min')
-    return moran[['rank_' + scale_id]]
+    # rank; plain arrays are much cheaper to send back than a DataFrame
+    ranks = min_rank_desc(moran['I'].to_numpy(np.float64)).astype(np.int32)
+    return moran.index.to_numpy(), ranks, scale_id
 
 
-def categorize_with_threshold(row, threshold_ratio=0.93):
-    """Categorize genes based on threshold ratio."""
-    regions = {
-        'early': row['mean_early'],
-        'mid': row['mean_mid'],
-        'late': row['mean_late']
-    }
-    sorted_regs = sorted(regions.items(), key=lambda x: x[1])
-    (reg1, val1), (reg2, val2) = sorted_regs[0], sorted_regs[1]
-    
-    if (val2 - val1) / val2 >= threshold_ratio:
-        return reg1
-    else:
-        return 'mixed'
+def build_rank_matrix(rank_tables):
+    """Outer-join per-scale (genes, ranks, scale_id) results into one matrix."""
+    genes = pd.Index(functools.reduce(
+        np.union1d, [scale_genes for scale_genes, _, _ in rank_tables]
+    ))
+    rows = np.concatenate([genes.get_indexer(g) for g, _, _ in rank_tables])
+    cols = np.repeat(np.arange(len(rank_tables)),
+                     [len(g) for g, _, _ in rank_tables])
+    vals = np.concatenate([r for _, r, _ in rank_tables]).astype(np.int32, copy=False)
+    
+    # Genes missing at a scale are ranked just below the worst observed rank
+    max_rank = int(vals.max())
+    mat = np.full((len(genes), len(rank_tables)), max_rank + 1, dtype=np.int32)
+    mat[rows, cols] = vals
+    return pd.DataFrame(mat, index=genes,
+                        columns=[f"rank_{scale_id}" for _, _, scale_id in rank_tables])
+
+
+def categorize_vectorized(df, threshold_ratio=0.93):
+    """Categorize genes based on threshold ratio (vectorized over rows)."""
+    labels = np.array(['early', 'mid', 'late'])
+    vals = df[['mean_early', 'mean_mid', 'mean_late']].to_numpy()
+    order = np.argsort(vals, axis=1, kind='stable')
+    val1 = np.take_along_axis(vals, order[:, :1], axis=1).ravel()
+    val2 = np.take_along_axis(vals, order[:, 1:2], axis=1).ravel()
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distinct = (val2 - val1) / val2 >= threshold_ratio
+    return np.where(distinct, labels[order[:, 0]], 'mixed')
+
+
+def top_k(df, col, k, ascending=True):
+    """Index labels of the k smallest (or largest) values of col, in order."""
+    v = df[col].to_numpy()
+    k = min(k, len(v))
+    if k == 0:
+        return []
+    key = v if ascending else -v
+    idx = np.argpartition(key, k - 1)[:k]
+    idx = idx[np.argsort(key[idx], kind='stable')]
+    return df.index[idx].tolist()
 
 
 def plot_traj(df, genes, xlabel, title):
     """Plot trajectory for genes."""
     plt.figure(figsize=(8, 4))
     x = np.arange(df.shape[1])
-    for g in genes:
-        plt.plot(x, df.loc[g], '-o', alpha=0.7, label=g)
+    # One plot call for all genes (one line per column of Y.T)
+    Y = df.loc[list(genes)].to_numpy()
+    lines = plt.plot(x, Y.T, '-o', alpha=0.7)
+    for line, g in zip(lines, genes):
+        line.set_label(g)
     plt.gca().invert_yaxis()
     plt.xticks(x, df.columns, rotation=45)
     plt.xlabel(xlabel)
@@ -139,84 +171,191 @@ def plot_traj(df, genes, xlabel, title):
     plt.show()
 
 
-def _render_gene_png_worker(gene: str, out_png: str, segment_key: str,
-                            normalize_total: bool, log1p: bool,
-                            title_prefix: str, tile_figsize: tuple,
-                            tile_dpi: int, adata_global=None):
-    """Worker function to render one gene PNG."""
+def _init_worker(adata, counts=None):
+    """Publish the AnnData (and optional CSC counts) to a pool worker."""
+    global _GLOBAL_ADATA, _GLOBAL_COUNTS
+    _GLOBAL_ADATA = adata
+    _GLOBAL_COUNTS = counts
+
+
+def _lognorm_gene_embedding(adata, genes: List[str], counts,
+                            segment_key=None):
+    """Fill X_gene_embedding with log-normalized expression, averaged per segment.
+    
+    Only the requested columns of ``counts`` (CSC matrix, per-spot totals)
+    are normalized to 1e4 and log1p-transformed. This is not checked
+    against SPIX add_gene_expression_embedding, hence opt-in only.
+    """
+    names = adata.var_names
+    cols = (names.get_indexer(genes) if names.is_unique
+            else [np.flatnonzero(names == g)[0] for g in genes])
+    X_csc, totals = counts
+    expr = X_csc[:, cols].toarray().astype(np.float32, copy=False)
+    # Per-spot factor in float32 so scaling stays in expr's dtype
+    scale = (1e4 / np.where(totals > 0, totals, 1)).astype(np.float32)
+    expr *= scale[:, None]
+    np.log1p(expr, out=expr)
+    
+    if segment_key is not None:
+        # Spots without a segment (code -1) keep their own value
+        codes, uniques = pd.factorize(adata.obs[segment_key])
+        seg = np.flatnonzero(codes >= 0)
+        # Segment x spot membership matrix: one sparse matmul sums all genes
+        membership = sparse.csr_matrix(
+            (np.ones(seg.size), (codes[seg], seg)),
+            shape=(len(uniques), expr.shape[0])
+        )
+        sums = membership @ expr
+        seg_sizes = np.bincount(codes[seg], minlength=len(uniques))
+        expr[seg] = sums[codes[seg]] / seg_sizes[codes[seg], None]
+    
+    adata.obsm['X_gene_embedding'] = expr
+
+
+def _render_gene_batch_worker(genes: List[str], segment_key: str,
+                              normalize_total: bool, log1p: bool,
+                              title_prefix: str, tile_figsize: tuple,
+                              tile_dpi: int) -> List[np.ndarray]:
+    """Worker function to render a batch of gene tiles as RGB arrays.
+    
+    All genes must be present in var_names; build_grid_for_group_parallel
+    filters them before submission.
+    """
     import SPIX
     import matplotlib.pyplot as plt
     
-    if adata_global is None:
-        raise ValueError("adata_global must be provided")
-    
-    adata = adata_global
-    
-    # Gracefully handle missing gene
-    if str(gene) not in set(map(str, adata.var_names)):
-        fig = plt.figure(figsize=tile_figsize)
-        plt.text(0.5, 0.5, f"{title_prefix}{gene}\n(not in var_names)",
-                ha='center', va='center')
-        plt.axis('off')
-        fig.savefig(out_png, dpi=tile_dpi, bbox_inches='tight')
-        plt.close(fig)
-        return out_png
+    adata = _GLOBAL_ADATA
+    if adata is None:
+        raise RuntimeError("grid worker was not initialized with an AnnData")
     
-    # Compute single-gene embedding
-    SPIX.an.add_gene_expression_embedding(
-        adata,
-        genes=[gene],
-        segment_key=segment_key,
-        normalize_total=normalize_total,
-        log1p=log1p
-    )
+    # One embedding per batch; dimension i holds genes[i]. With
+    # --grid_csc_lognorm, normalize only the batch's count columns instead
+    # of letting SPIX renormalize the whole matrix in every worker.
+    if normalize_total and log1p and _GLOBAL_COUNTS is not None:
+        _lognorm_gene_embedding(adata, genes, _GLOBAL_COUNTS, segment_key)
+    else:
+        SPIX.an.add_gene_expression_embedding(
+            adata,
+            genes=list(genes),
+            segment_key=segment_key,
+            normalize_total=normalize_total,
+            log1p=log1p
+        )
     
-    # Plot using the single dimension [0]
-    SPIX.pl.image_plot(
-        adata,
-        dimensions=[0],
-        embedding='X_gene_embedding',
-        boundary_method='pixel',
-        imshow_tile_size=10,
-        imshow_scale_factor=1,
-        figsize=tile_figsize,
-        fixed_boundary_color='Black',
-        cmap='viridis',
-        boundary_linewidth=1,
-        show_colorbar=True,
-        prioritize_high_values=True,
-        title=f"{title_prefix}{gene}",
-        alpha=1,
-        plot_boundaries=False,
-        origin=True
-    )
-    plt.savefig(out_png, dpi=tile_dpi, bbox_inches='tight')
-    plt.close()
+    tiles = []
+    for i, gene in enumerate(genes):
+        open_figs = set(plt.get_fignums())
+        SPIX.pl.image_plot(
+            adata,
+            dimensions=[i],
+            embedding='X_gene_embedding',
+            boundary_method='pixel',
+            imshow_tile_size=10,
+            imshow_scale_factor=1,
+            figsize=tile_figsize,
+            fixed_boundary_color='Black',
+            cmap='viridis',
+            boundary_linewidth=1,
+            show_colorbar=True,
+            prioritize_high_values=True,
+            title=f"{title_prefix}{gene}",
+            alpha=1,
+            plot_boundaries=False,
+            origin=True
+        )
+        # image_plot does not return its Figure: grab it, then close every
+        # figure it opened so none linger in the pyplot registry. Shrink to
+        # the grid cell here so only cell-sized arrays cross the pipe.
+        tiles.append(_fit_tile(_figure_to_rgb(plt.gcf(), tile_dpi),
+                               GRID_CELL_INCHES * tile_dpi))
+        for num in set(plt.get_fignums()) - open_figs:
+            plt.close(num)
     
     gc.collect()
-    return out_png
+    return tiles
+
+
+def _render_missing_gene_tile(gene: str, title_prefix: str,
+                              tile_figsize: tuple, tile_dpi: int) -> np.ndarray:
+    """Render a placeholder tile for a gene that is not in var_names."""
+    fig = Figure(figsize=tile_figsize)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.text(0.5, 0.5, f"{title_prefix}{gene}\n(not in var_names)",
+            ha='center', va='center', transform=ax.transAxes)
+    ax.axis('off')
+    return _fit_tile(_figure_to_rgb(fig, tile_dpi), GRID_CELL_INCHES * tile_dpi)
 
 
-def _assemble_grid(tile_paths: List[str], out_path: str, cols: int = 5,
+def _figure_to_rgb(fig, dpi: int) -> np.ndarray:
+    """Rasterize a figure to RGB uint8, cropped to its non-white content."""
+    fig.set_dpi(dpi)
+    fig.canvas.draw()
+    rgb = np.asarray(fig.canvas.buffer_rgba())[:, :, :3]
+    
+    # Crop to the drawn content; unlike bbox_inches='tight' there is no
+    # padding and white artists at the edges are trimmed too
+    ink = (rgb != 255).any(axis=2)
+    ink_rows = np.flatnonzero(ink.any(axis=1))
+    ink_cols = np.flatnonzero(ink.any(axis=0))
+    if ink_rows.size:
+        rgb = rgb[ink_rows[0]:ink_rows[-1] + 1, ink_cols[0]:ink_cols[-1] + 1]
+    return rgb.copy()
+
+
+def _fit_tile(rgb: np.ndarray, max_px: int) -> np.ndarray:
+    """Downscale an RGB tile to fit a max_px square, keeping its aspect ratio."""
+    h, w = rgb.shape[:2]
+    scale = max_px / max(h, w)
+    if scale >= 1:
+        return rgb
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    return np.asarray(Image.fromarray(rgb).resize(size, Image.LANCZOS))
+
+
+def _render_title_band(text: str, width: int, height: int,
+                       dpi: int) -> np.ndarray:
+    """Render a centred title into an RGB uint8 band of the given size."""
+    fig = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    fig.text(0.5, 0.5, text, ha='center', va='center',
+             fontsize=0.4 * height * 72 / dpi)
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba())[:, :, :3].copy()
+
+
+def _assemble_grid(tiles: List[np.ndarray], out_path: str, cols: int = 5,
                    suptitle: str = "", dpi: int = 150):
-    """Assemble saved PNG tiles into a grid figure."""
-    rows = math.ceil(len(tile_paths) / cols) if tile_paths else 1
-    fig, axes = plt.subplots(rows, cols, figsize=(cols * 4, rows * 4),
-                            squeeze=False)
+    """Assemble rendered RGB tiles into a grid image."""
+    if not tiles:
+        warnings.warn(f"No tiles to assemble for {out_path}")
+        return
+    
+    # Each tile is shrunk into a GRID_CELL_INCHES square at dpi, so the
+    # canvas size does not grow with the tile render dpi. Fitted tiles can
+    # still differ by a few pixels; pad each cell to the largest one.
+    cell_px = GRID_CELL_INCHES * dpi
+    tiles = [_fit_tile(t, cell_px) for t in tiles]
+    rows = math.ceil(len(tiles) / cols)
+    H = max(t.shape[0] for t in tiles)
+    W = max(t.shape[1] for t in tiles)
+    title_h = max(H // 10, 20) if suptitle else 0
+    canvas = np.full((title_h + rows * H, cols * W, 3), 255, dtype=np.uint8)
+    
     if suptitle:
-        fig.suptitle(suptitle, fontsize=16)
-    i = 0
-    for r in range(rows):
-        for c in range(cols):
-            ax = axes[r][c]
-            ax.axis('off')
-            if i < len(tile_paths):
-                img = Image.open(tile_paths[i])
-                ax.imshow(img)
-            i += 1
-    plt.tight_layout(rect=[0, 0, 1, 0.96])
-    plt.savefig(out_path, dpi=dpi, bbox_inches='tight')
-    plt.close(fig)
+        band = _render_title_band(suptitle, cols * W, title_h, dpi)
+        bh, bw = min(band.shape[0], title_h), min(band.shape[1], cols * W)
+        canvas[:bh, :bw] = band[:bh, :bw]
+    
+    for k, tile in enumerate(tiles):
+        r, c = divmod(k, cols)
+        h, w = tile.shape[:2]
+        y0 = title_h + r * H + (H - h) // 2
+        x0 = c * W + (W - w) // 2
+        canvas[y0:y0 + h, x0:x0 + w] = tile
+    
+    # Fast zlib level: the grid is large and written once
+    Image.fromarray(canvas).save(out_path, dpi=(dpi, dpi), compress_level=1)
 
 
 def build_grid_for_group_parallel(group_name: str, genes: List[str],
@@ -224,38 +363,61 @@ def build_grid_for_group_parallel(group_name: str, genes: List[str],
                                   cols: int = 5, tile_figsize=(10, 10),
                                   tile_dpi=150, segment_key='Segment',
                                   normalize_total=True, log1p=True,
-                                  max_workers=6):
-    """Run per-gene SPIX rendering in parallel, then assemble grid."""
+                                  max_workers=6, counts=None):
+    """Run per-gene SPIX rendering in parallel, then assemble grid.
+    
+    ``counts`` is an optional (CSC counts, per-spot totals) pair used to
+    log-normalize tiles column-wise instead of through SPIX.
+    """
     if not genes:
         warnings.warn(f"[{group_name}] No genes to render.")
         return None
     
     os.makedirs(out_dir, exist_ok=True)
-    tmp_dir = os.path.join(out_dir, f"tiles_{group_name}")
-    os.makedirs(tmp_dir, exist_ok=True)
-    
     out_png = os.path.join(out_dir, f"grid_{group_name}.png")
     
-    # Submit jobs
-    ordered_tiles = [os.path.join(tmp_dir, f"{g}.png") for g in genes]
-    with ProcessPoolExecutor(max_workers=max_workers) as ex:
-        futures = []
-        for g, png in zip(genes, ordered_tiles):
-            futures.append(
-                ex.submit(
-                    _render_gene_png_worker,
-                    g, png, segment_key, normalize_total, log1p,
-                    f"{group_name} | ", tile_figsize, tile_dpi, adata_global
-                )
-            )
-        # Ensure all complete
-        for f in as_completed(futures):
-            _ = f.result()
-    
-    # Assemble in original order
-    existing_tiles = [p for p in ordered_tiles if os.path.exists(p)]
-    _assemble_grid(existing_tiles, out_path=out_png, cols=cols,
-                  suptitle=f"{group_name} (n={len(existing_tiles)})",
+    # Heavy state goes through the pool initializer once per worker rather
+    # than with every task. Under fork the initargs are inherited
+    # copy-on-write; under spawn (macOS, Windows) they are pickled once per
+    # worker.
+    mp_context = (mp.get_context('fork')
+                  if 'fork' in mp.get_all_start_methods() else None)
+    title_prefix = f"{group_name} | "
+    
+    # Gracefully handle missing genes with a hash lookup on var_names,
+    # before anything is sent to the workers
+    found = pd.Index(genes).isin(adata_global.var_names)
+    present = [g for g, ok in zip(genes, found) if ok]
+    
+    # Submit jobs; workers hand back RGB arrays, so tiles never go through
+    # PNG encode/decode
+    rendered = {}
+    if present:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context,
+                                 initializer=_init_worker,
+                                 initargs=(adata_global, counts)) as ex:
+            futures = []
+            # One evenly sized batch of genes per worker
+            for idx in np.array_split(np.arange(len(present)),
+                                      min(max_workers, len(present))):
+                batch = [present[i] for i in idx]
+                futures.append((batch, ex.submit(
+                    _render_gene_batch_worker,
+                    batch, segment_key, normalize_total, log1p,
+                    title_prefix, tile_figsize, tile_dpi
+                )))
+            for batch, f in futures:
+                rendered.update(zip(batch, f.result()))
+    
+    # Collect in original order
+    tiles = [
+        rendered[g] if ok else
+        _render_missing_gene_tile(g, title_prefix, tile_figsize, tile_dpi)
+        for g, ok in zip(genes, found)
+    ]
+    
+    _assemble_grid(tiles, out_path=out_png, cols=cols,
+                  suptitle=f"{group_name} (n={len(tiles)})",
                   dpi=tile_dpi)
     
     print(f"[Saved] {out_png}")
@@ -312,7 +474,12 @@ def main():
                        help='Comma-separated list of compactnesses')
     parser.add_argument('--n_jobs_multiscale', type=int, default=3)
     parser.add_argument('--moran_thresh', type=float, default=0)
-    parser.add_argument('--use_memmap', action='store_true', default=False)
+    parser.add_argument('--use_memmap', action='store_true', default=False,
+                       help='Deprecated; ignored')
+    parser.add_argument('--grid_csc_lognorm', action='store_true', default=False,
+                       help='Log-normalize gene grid tiles from CSC count columns '
+                            'instead of SPIX add_gene_expression_embedding '
+                            '(builds a CSC copy of X)')
     
     # Categorization
     parser.add_argument('--threshold_ratio', type=float, default=0.93)
@@ -330,6 +497,8 @@ def main():
     parser.add_argument('--show_plots', action='store_true', default=False)
     
     args = parser.parse_args()
+    if args.use_memmap:
+        warnings.warn("--use_memmap is deprecated and has no effect")
     
     # Setup environment
     setup_environment(
@@ -340,7 +509,9 @@ def main():
     # Parse resolutions and compactnesses
     resolutions = [float(x) for x in args.resolutions.split(',')]
     compactnesses = [float(x) for x in args.compactnesses.split(',')]
+    # Built once and shared by every SPIX call below
     dims_use = list(range(args.dimensions))
+    tile_figsize = tuple(args.tile_figsize)
     segment_method = 'image_plot_slic'
     embedding_key = 'X_embedding_equalize'
     use_cached_image = True
@@ -378,7 +549,7 @@ def main():
         adata,
         methods=['graph', 'gaussian'],
         embedding='X_embedding',
-        embedding_dims=list(range(args.dimensions)),
+        embedding_dims=dims_use,
         graph_k=args.graph_k,
         graph_t=args.graph_t,
         gaussian_sigma=args.gaussian_sigma,
@@ -389,7 +560,7 @@ def main():
     print("Equalizing image...")
     adata = SPIX.ip.equalize_image(
         adata,
-        dimensions=list(range(args.dimensions)),
+        dimensions=dims_use,
         embedding='X_embedding_smooth',
         sleft=args.sleft,
         sright=args.sright
@@ -400,7 +571,7 @@ def main():
     cache_embedding_image(
         adata,
         embedding='X_embedding_equalize',
-        dimensions=list(range(args.dimensions)),
+        dimensions=dims_use,
         key='image_plot_slic',
         origin=True,
         figsize=(30, 30),
@@ -416,7 +587,7 @@ def main():
     print("Segmenting image...")
     SPIX.sp.segment_image(
         adata,
-        dimensions=list(range(args.dimensions)),
+        dimensions=dims_use,
         embedding='X_embedding_equalize',
         method='image_plot_slic',
         pitch_um=args.pitch_um,
@@ -449,18 +620,16 @@ def main():
     
     # Multiscale analysis
     print("Starting multiscale analysis...")
-    param_grid = list(itertools.product(resolutions, compactnesses))
+    # Numeric (r, c) order; the rank matrix columns follow it
+    param_grid = sorted(itertools.product(resolutions, compactnesses))
     print(f"▶ Total {len(param_grid)} scales")
     
-    adata_path = None
-    if args.use_memmap:
-        td = tempfile.mkdtemp()
-        adata_path = os.path.join(td, 'adata_tmp.h5ad')
-        adata.write_h5ad(adata_path)
+    # Compile the ranking kernel once so workers load it from the numba cache
+    min_rank_desc(np.zeros(1, dtype=np.float64))
     
     results = Parallel(n_jobs=args.n_jobs_multiscale, backend='loky', verbose=10)(
         delayed(calc_scale)(
-            adata, f"r{r}_c{c}", r, c, adata_path,
+            adata, f"r{r}_c{c}", r, c,
             dims_use=dims_use, embedding_key=embedding_key,
             segment_method=segment_method, use_cached_image=use_cached_image,
             moran_thresh=args.moran_thresh
@@ -468,27 +637,28 @@ def main():
         for r, c in param_grid
     )
     
-    if args.use_memmap:
-        shutil.rmtree(td)
-    
     # Concat rank table
     print("Concatenating rank tables...")
-    rank_tables = [df for df in results if not df.empty]
-    rank_mat = pd.concat(rank_tables, axis=1, join='outer')
-    max_rank = int(rank_mat.max().max())
-    rank_mat = rank_mat.fillna(max_rank + 1)
-    rank_mat.sort_index(axis=1, inplace=True)
-    
-    # Resolution / compactness axis
-    res_rank = pd.DataFrame(index=rank_mat.index)
-    for r in resolutions:
-        cols = [f"rank_r{r}_c{c}" for c in compactnesses]
-        res_rank[f"res_{r}"] = rank_mat[cols].mean(axis=1)
-    
-    comp_rank = pd.DataFrame(index=rank_mat.index)
-    for c in compactnesses:
-        cols = [f"rank_r{r}_c{c}" for r in resolutions]
-        comp_rank[f"comp_{c}"] = rank_mat[cols].mean(axis=1)
+    rank_tables = [res for res in results if res is not None]
+    rank_mat = build_rank_matrix(rank_tables)
+    # Column order comes straight from the (numerically sorted) grid;
+    # scales that returned no genes are simply absent
+    ordered_cols = [f"rank_r{r}_c{c}" for r, c in param_grid]
+    rank_mat = rank_mat.reindex(
+        columns=[col for col in ordered_cols if col in rank_mat.columns]
+    )
+    
+    # Resolution / compactness axis: one grouped mean per level
+    scale_params = {f"rank_r{r}_c{c}": (r, c) for r, c in param_grid}
+    # Ranks are stored exactly as int32; average them in float32
+    by_scale = rank_mat.T.astype(np.float32)
+    by_scale.index = pd.MultiIndex.from_tuples(
+        [scale_params[col] for col in rank_mat.columns], names=['res', 'comp']
+    )
+    res_rank = by_scale.groupby(level='res').mean().T
+    res_rank.columns = [f"res_{r:g}" for r in res_rank.columns]
+    comp_rank = by_scale.groupby(level='comp').mean().T
+    comp_rank.columns = [f"comp_{c:g}" for c in comp_rank.columns]
     
     df = res_rank.copy()
     
@@ -502,10 +672,7 @@ def main():
     df['mean_mid'] = df[mid_cols].mean(axis=1)
     df['mean_late'] = df[late_cols].mean(axis=1)
     
-    df['category'] = df.apply(
-        lambda row: categorize_with_threshold(row, args.threshold_ratio),
-        axis=1
-    )
+    df['category'] = categorize_vectorized(df, args.threshold_ratio)
     
     print(df['category'].value_counts())
     print(df[['mean_early', 'mean_mid', 'mean_late', 'category']].head())
@@ -516,65 +683,66 @@ def main():
     if args.show_plots:
         plot_traj(
             res_rank,
-            df[df['category'] == 'early'].sort_values('mean_early').head(10).index.tolist(),
+            top_k(df[df['category'] == 'early'], 'mean_early', 10),
             'Resolution',
             'Unique in high resolution'
         )
         plot_traj(
             res_rank,
-            df[df['category'] == 'late'].sort_values('mean_late').head(10).index.tolist(),
+            top_k(df[df['category'] == 'late'], 'mean_late', 10),
             'Resolution',
             'Unique in low resolution'
         )
         plot_traj(
             res_rank,
-            df[df['category'] == 'late'].sort_values('mean_mid', ascending=False).head(10).index.tolist(),
+            top_k(df[df['category'] == 'late'], 'mean_mid', 10, ascending=False),
             'Resolution',
             'Unique in low resolution'
         )
         plot_traj(
             res_rank,
-            df[df['category'] == 'mid'].sort_values('mean_early', ascending=False).head(10).index.tolist(),
+            top_k(df[df['category'] == 'mid'], 'mean_early', 10, ascending=False),
             'Resolution',
             'Unique in middle resolution'
         )
     
     # Build grids
     print("Building gene grids...")
-    tile_figsize_tuple = tuple(args.tile_figsize)
-    
-    # Try to set fork start method for multiprocessing
-    try:
-        mp.set_start_method("fork", force=True)
-    except RuntimeError:
-        pass
+    # Opt-in: tiles normalize their own CSC columns against per-spot totals
+    # computed once here, not the whole matrix per worker
+    gene_counts = None
+    if args.grid_csc_lognorm:
+        gene_counts = (sparse.csc_matrix(adata.X),
+                       np.asarray(adata.X.sum(axis=1, dtype=np.float64)).ravel())
     
     build_grid_for_group_parallel(
         group_name=f"moran_late_500_top{args.top_k}",
-        genes=df[df['category'] == 'late'].sort_values('mean_late').head(args.top_k).index.tolist(),
+        genes=top_k(df[df['category'] == 'late'], 'mean_late', args.top_k),
         adata_global=adata,
         out_dir=args.out_dir,
         cols=args.group_cols,
-        tile_figsize=tile_figsize_tuple,
+        tile_figsize=tile_figsize,
         tile_dpi=args.tile_dpi,
         segment_key="Segment",
         normalize_total=True,
         log1p=True,
-        max_workers=args.max_workers
+        max_workers=args.max_workers,
+        counts=gene_counts
     )
     
     build_grid_for_group_parallel(
         group_name=f"moran_late_m_mid_500_top{args.top_k}",
-        genes=df[df['category'] == 'late'].sort_values('late_m_mid', ascending=True).head(args.top_k).index.tolist(),
+        genes=top_k(df[df['category'] == 'late'], 'late_m_mid', args.top_k),
         adata_global=adata,
         out_dir=args.out_dir,
         cols=args.group_cols,
-        tile_figsize=tile_figsize_tuple,
+        tile_figsize=tile_figsize,
         tile_dpi=args.tile_dpi,
         segment_key="Segment",
         normalize_total=True,
         log1p=True,
-        max_workers=args.max_workers
+        max_workers=args.max_workers,
+        counts=gene_counts
     )
     
     print("Pipeline completed successfully!")
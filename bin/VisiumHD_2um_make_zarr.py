@@ -4,9 +4,37 @@ Convert VisiumHD data to zarr format.
 """
 
 import argparse
+import os
+
+import numcodecs
+import zarr
+from anndata.experimental import write_dispatched
+from numcodecs import Blosc
+from scipy import sparse
 import spatialdata_io
 
 
+def write_table_zarr(adata, path, target_chunk_bytes=1_000_000):
+    """Write an AnnData table to a zarr (v2 format) store.
+    
+    Every array is compressed with Blosc/zstd. anndata's write_zarr ignores
+    chunks for sparse X, so X's 1-D data/indices/indptr arrays are chunked
+    here into ~target_chunk_bytes blocks.
+    """
+    compressor = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)
+    adata.strings_to_categoricals()
+    
+    def callback(func, store, key, elem, dataset_kwargs, iospec):
+        if key == "/X" and sparse.issparse(elem):
+            chunk_len = max(1, target_chunk_bytes // elem.data.dtype.itemsize)
+            dataset_kwargs = dict(dataset_kwargs, chunks=(chunk_len,))
+        func(store, key, elem, dataset_kwargs=dataset_kwargs)
+    
+    store = zarr.open(path, mode='w')
+    write_dispatched(store, "/", adata, callback=callback,
+                     dataset_kwargs={'compressor': compressor})
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Convert VisiumHD data to zarr format'
@@ -29,6 +57,12 @@ def main():
         required=True,
         help='Output zarr path'
     )
+    parser.add_argument(
+        '--copy',
+        action='store_true',
+        default=False,
+        help='Write a detached copy of the table instead of writing it in place'
+    )
     
     args = parser.parse_args()
     
@@ -43,11 +77,16 @@ def main():
     # Extract AnnData table
     table_key = f'square_{args.bin_size:03d}um'
     print(f"Extracting table: {table_key}")
-    adata = sdata.tables[table_key].copy()
+    adata = sdata.tables[table_key]
+    if args.copy:
+        adata = adata.copy()
     
     # Write to zarr
     print(f"Writing to zarr: {args.output}")
-    adata.write_zarr(args.output)
+    # Blosc compresses on its own thread pool, sized to the CPUs this task
+    # may use (Nextflow's cpus limit) rather than the host's core count
+    numcodecs.blosc.set_nthreads(len(os.sched_getaffinity(0)))
+    write_table_zarr(adata, args.output)
     print(f"Successfully saved to: {args.output}")
 
 
@@ -0,0 +1,24 @@
+"""
+Numba-compiled ranking helpers shared by the multiscale workflows.
+"""
+
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def min_rank_desc(x):
+    """Rank values in descending order; ties share the smallest rank."""
+    n = x.shape[0]
+    order = np.argsort(-x)
+    ranks = np.empty(n, np.int64)
+    i = 0
+    while i < n:
+        # Walk the run of values tied with x[order[i]]
+        j = i
+        while j + 1 < n and x[order[j + 1]] == x[order[i]]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[order[k]] = i + 1
+        i = j + 1
+    return ranks